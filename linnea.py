@@ -26,21 +26,28 @@ function_map = {
     'count':    ['REGEXP_COUNT(',0,',',1,')']
 }
 
+bucket_template = "TIME_SLICE({timestamp}, {seconds}, 'SECOND')"
+
 with_group_by = True
 
 timestamp_format = '%Y-%m-%d %H:%M:%S'
 timestamp_file_format = '%Y-%m-%d-%H-%M-%S'
 
-def compile_source(src, timestamp, with_group_by):
+def odbc_connection_string(config):
+    return Template(config['odbc']['connect_template']).substitute(**config['odbc'])
+
+def make_compiler(timestamp, with_group_by, bucket_minutes=0):
     t_to_str   = timestamp.strftime(timestamp_format)
     imap = dict(identifier_map)
     imap['t0'] = "(TIMESTAMP '%s')" % t_to_str
     
-    compiler = SQLCompiler(table_name, imap, function_map, with_group_by)
-    
-    return compiler.compileSQL(src)
+    return SQLCompiler(table_name, imap, function_map, with_group_by,
+                       bucket_seconds=int(bucket_minutes)*60 or None, bucket_template=bucket_template)
+
+def compile_source(src, timestamp, with_group_by, bucket_minutes=0):
+    return make_compiler(timestamp, with_group_by, bucket_minutes).compileSQL(src)
 
-def main(filename, timestamp=None, with_group_by=with_group_by, execute=False):
+def main(filename, timestamp=None, with_group_by=with_group_by, execute=False, bucket_minutes=0):
     if filename == 'batch':
         batch_execute('examples', True)
         return 
@@ -51,7 +58,11 @@ def main(filename, timestamp=None, with_group_by=with_group_by, execute=False):
     else:
         timestamp = datetime.strptime(timestamp, timestamp_format)
     
-    sql_query = compile_source(source, timestamp, int(with_group_by))
+    if execute == 'local':
+        execute_local(source, timestamp, int(with_group_by), bucket_minutes)
+        return
+    
+    sql_query = compile_source(source, timestamp, int(with_group_by), bucket_minutes)
     
     if not int(execute):
         print(sql_query)
@@ -60,9 +71,7 @@ def main(filename, timestamp=None, with_group_by=with_group_by, execute=False):
         import pyodbc
         config = pytoml.loads(open('config.toml').read())
         
-        odbc_connection_template = Template(config['odbc']['connect_template'])
-        odbc_connection_string = odbc_connection_template.substitute(**config['odbc'])
-        connection = pyodbc.connect(odbc_connection_string)
+        connection = pyodbc.connect(odbc_connection_string(config))
         cur = connection.cursor()
         cur.execute(sql_query)
         
@@ -70,6 +79,41 @@ def main(filename, timestamp=None, with_group_by=with_group_by, execute=False):
         for row in cur:
             print(*row, sep='\t| ')
 
+def execute_local(src, timestamp, with_group_by=with_group_by, bucket_minutes=0):
+    '''
+    Runs a program on the local stand-in engine, fed from the slice cache,
+    which only fetches the hours it does not hold yet. The hours are those
+    between the time bounds relative to t0 of the first predicate set.
+    '''
+    import pytoml
+    import linnea_cache
+    import linnea_local
+    import linnea_range
+    config = pytoml.loads(open('config.toml').read())
+    
+    lower, upper = linnea_range.root_bounds(src)
+    if lower is None or upper is None:
+        raise ValueError('Local execution needs lower and upper bounds of the timestamp relative to t0 in the first predicate set.')
+    start, end = timestamp + lower, timestamp + upper
+    
+    cache = linnea_cache.SliceCache(config['cache']['directory'], config['cache']['max_megabytes'] * 2**20)
+    if cache.missing(start, end):
+        import pyodbc
+        warehouse = pyodbc.connect(odbc_connection_string(config))
+        try:
+            cache.fetch(warehouse, start, end)
+        finally:
+            warehouse.close()
+    
+    connection = linnea_local.connect()
+    linnea_local.create_table(connection)
+    linnea_cache.load_local(connection, cache.load(start, end), linnea_local.epoch(start), linnea_local.epoch(end))
+    cur = linnea_local.execute(connection, linnea_local.compile_source(src, timestamp, with_group_by, bucket_minutes))
+    
+    print('-'*79)
+    for row in cur:
+        print(*row, sep='\t| ')
+
 def batch_execute(directory, with_group_by=with_group_by):
     import pytoml
     import pyodbc
@@ -79,6 +123,14 @@ def batch_execute(directory, with_group_by=with_group_by):
     files = config['batch']['dgas']
     days = config['batch']['days']
     hours = config['batch']['hours']
+    bucket_minutes = config['batch'].get('bucket_minutes', 0)
+    incremental = config['batch'].get('incremental', False)
+    probe = config['batch'].get('probe', False)
+    bucket_rows_per_client = config['batch'].get('bucket_rows_per_client', 1000)
+    if incremental:
+        from linnea_incremental import compile_incremental
+    elif probe:
+        import linnea_probe
             
     class FileAndStdout():
         def __init__(self, filename):
@@ -99,9 +151,7 @@ def batch_execute(directory, with_group_by=with_group_by):
     
     save_results = True
     
-    odbc_connection_template = Template(config['odbc']['connect_template'])
-    odbc_connection_string = odbc_connection_template.substitute(**config['odbc'])
-    connection = pyodbc.connect(odbc_connection_string)
+    connection = pyodbc.connect(odbc_connection_string(config))
     
     cur = connection.cursor()
     total_results = {}
@@ -121,20 +171,37 @@ def batch_execute(directory, with_group_by=with_group_by):
             result_set = set()
             for hour in hours:
                 t = datetime.strptime("%s %s" % (day, hour), timestamp_format)
-                sql_query = compile_source(src, t, with_group_by)
+                probe_time = 0
+                if incremental:
+                    before, sql_query, after = compile_incremental(make_compiler(t, with_group_by, bucket_minutes), src, f)
+                elif probe:
+                    t0 = time.time()
+                    sql_query, _, _ = linnea_probe.plan(connection, make_compiler, src, t, with_group_by, bucket_minutes, bucket_rows_per_client)
+                    before, after = [], []
+                    probe_time = time.time() - t0
+                else:
+                    before, sql_query, after = [], compile_source(src, t, with_group_by, bucket_minutes), []
                 
                 cur = connection.cursor()
                 t0 = time.time()
-                cur.execute(sql_query)
-                dt = (time.time() - t0)
+                for statement in before:
+                    cur.execute(statement)
+                if sql_query is not None:
+                    cur.execute(sql_query)
+                dt = (time.time() - t0) + probe_time
                 print('%.2fs' % dt, end=' ')
                 
                 if save_results:
                     print('--------- At %s ---------' % hour, file=result_file)
-                    for row in cur:
+                    for row in (cur if sql_query is not None else []):
                         results = list(row)
                         print(*results, sep='\t| ', file=result_file)
                         result_set.add(results[0])
+                
+                for statement in after:
+                    cur.execute(statement)
+                if after:
+                    connection.commit()
             
                 exec_times.append(dt)
                 total_exec_times.append(dt)
@@ -0,0 +1,248 @@
+'''
+Asyncio API for Linnea.
+
+Compiles programs and runs the queries on worker threads, so many detectors
+can run concurrently from an event loop:
+
+    api = AsyncLinnea(lambda: pyodbc.connect(connection_string), max_concurrency=4)
+    sql_query = await api.compile(src, timestamp)
+    async with api.submit(sql_query, timeout=60) as result:
+        async for row in result:
+            ...
+
+Every query gets its own connection. At most max_concurrency queries run at
+once, results are streamed through a bounded buffer, so a slow consumer
+stalls the fetching instead of filling memory. Once a query exceeds its
+deadline, it is cancelled on the server and asyncio.TimeoutError is raised.
+Closing a result early cancels its query as well.
+'''
+from __future__ import print_function
+
+import asyncio
+import concurrent.futures
+import linnea
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryResult(object):
+    '''
+    The streamed rows of a submitted query, an asynchronous iterator within
+    `async with`, which starts the query and cancels it on leaving.
+    '''
+
+    _done = object()
+
+    def __init__(self, api, sql_query, timeout, buffer_batches):
+        self.api = api
+        self.sql_query = sql_query
+        self.timeout = timeout
+        self.buffer_batches = buffer_batches
+        self.started = False
+        self.finished = False
+        self._cancelled = threading.Event()
+        self._stopped = threading.Event()
+        self._connection = None
+        self._cursor = None
+        self._batch = []
+
+    async def __aenter__(self):
+        await self._start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.started:
+            raise RuntimeError('Iterate results within async with, which closes them.')
+        while not self._batch:
+            if self.finished:
+                raise StopAsyncIteration
+            batch = await self._get()
+            if batch is self._done:
+                self._finish()
+                raise StopAsyncIteration
+            if isinstance(batch, BaseException):
+                self._finish()
+                raise batch
+            self._batch = list(reversed(batch))
+        return self._batch.pop()
+
+    async def fetchall(self):
+        rows = []
+        async for row in self:
+            rows.append(row)
+        return rows
+
+    async def _start(self):
+        '''
+        Waits for a free slot and starts the query.
+        '''
+        self.started = True
+        self._loop = asyncio.get_event_loop()
+        self._deadline = self._loop.time() + self.timeout if self.timeout is not None else None
+        try:
+            await self._wait(self.api.semaphore().acquire())
+        except asyncio.TimeoutError:
+            self.finished = True
+            raise
+        self._queue = asyncio.Queue(self.buffer_batches)
+        self._worker = self._loop.run_in_executor(self.api._executor, self._run)
+
+    async def close(self):
+        '''
+        Cancels the query if it is still running, its slot is released once
+        the worker has stopped.
+        '''
+        if self.started and not self.finished:
+            self._cancel()
+            self._finish()
+
+    async def _wait(self, awaitable):
+        if self._deadline is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, max(0, self._deadline - self._loop.time()))
+
+    async def _get(self):
+        try:
+            return await self._wait(self._queue.get())
+        except asyncio.TimeoutError:
+            self._cancel()
+            self._finish()
+            raise
+
+    def _cancel(self):
+        if not self._cancelled.is_set():
+            self._cancelled.set()
+            self._loop.run_in_executor(None, self._cancel_server)
+
+    def _cancel_server(self):
+        '''
+        Cancels the query until the worker stops, a cancel arriving before the
+        query started would be lost otherwise.
+        '''
+        while not self._stopped.is_set():
+            try:
+                if self._cursor is not None and hasattr(self._cursor, 'cancel'):
+                    self._cursor.cancel()
+                elif self._connection is not None and hasattr(self._connection, 'interrupt'):
+                    self._connection.interrupt()
+                elif self._connection is not None:
+                    logger.warning('Connection cannot cancel queries, the query runs on until it ends.')
+                    return
+            except Exception:
+                logger.exception('Cancelling the query failed.')
+                return
+            self._stopped.wait(0.1)
+
+    def _finish(self):
+        '''
+        Marks the result finished, the slot is released when the worker stops.
+        '''
+        if self.finished:
+            return
+        self.finished = True
+        self._worker.add_done_callback(lambda _: self.api.semaphore().release())
+
+    def _put(self, item):
+        '''
+        Hands an item to the event loop, blocks while the buffer is full.
+        '''
+        if self._cancelled.is_set():
+            return
+        put = self._queue.put(item)
+        try:
+            future = asyncio.run_coroutine_threadsafe(put, self._loop)
+        except RuntimeError:
+            # The event loop is closed
+            put.close()
+            return
+        while True:
+            try:
+                return future.result(0.1)
+            except concurrent.futures.TimeoutError:
+                if self._cancelled.is_set():
+                    future.cancel()
+                    return
+
+    def _run(self):
+        try:
+            self._connection = self.api.connect()
+            try:
+                self._cursor = self._connection.cursor()
+                if self._cancelled.is_set():
+                    return
+                self._cursor.execute(self.sql_query)
+                while not self._cancelled.is_set():
+                    batch = self._cursor.fetchmany(self.api.batch_size)
+                    if not batch:
+                        break
+                    self._put(batch)
+            finally:
+                self._stopped.set()
+                self._connection.close()
+        except Exception as e:
+            self._put(e)
+            return
+        finally:
+            self._stopped.set()
+        self._put(self._done)
+
+class AsyncLinnea(object):
+    '''
+    - connect: callable returning a new DB-API connection
+    - max_concurrency: number of queries running at the same time
+    - timeout: default deadline of a query in seconds, including the wait for a slot
+    - batch_size: rows fetched at once
+    - buffer_batches: fetched batches held before fetching stalls
+    '''
+
+    def __init__(self, connect, max_concurrency=4, timeout=None, batch_size=1000, buffer_batches=4):
+        self.connect = connect
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.buffer_batches = buffer_batches
+        self._semaphore = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+
+    def semaphore(self):
+        '''
+        Limits the running queries. It is created on first use within the
+        event loop, as Python before 3.10 binds it to the current loop.
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def compile(self, src, timestamp, with_group_by=linnea.with_group_by, bucket_minutes=0, compile_source=linnea.compile_source):
+        return await asyncio.get_event_loop().run_in_executor(None, compile_source, src, timestamp, with_group_by, bucket_minutes)
+
+    def submit(self, sql_query, timeout=None):
+        '''
+        Returns the QueryResult of a query, it starts on entering it with
+        async with.
+        '''
+        return QueryResult(self, sql_query, self.timeout if timeout is None else timeout, self.buffer_batches)
+
+    async def execute(self, sql_query, timeout=None):
+        async with self.submit(sql_query, timeout) as result:
+            return await result.fetchall()
+
+    async def run(self, src, timestamp, with_group_by=linnea.with_group_by, bucket_minutes=0, timeout=None,
+                  compile_source=linnea.compile_source):
+        '''
+        Compiles and executes a program, returns all rows.
+        '''
+        sql_query = await self.compile(src, timestamp, with_group_by, bucket_minutes, compile_source)
+        return await self.execute(sql_query, timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,271 @@
+'''
+Synthetic DNS workload and scaling benchmark for Linnea detectors.
+
+Generates a seeded hplDNSReplies workload that mixes benign traffic with
+clients infected by the DGA families in examples/, loads it into the local
+stand-in engine and runs every detector on it, recording latency, peak memory
+and detection recall.
+'''
+from __future__ import print_function, division
+
+from datetime import datetime, timedelta
+import linnea_local
+import random
+import string
+import time
+
+
+letters = string.ascii_lowercase
+consonants = 'bcdfghjklmnpqrstvwxz'
+vowels = 'aeiouy'
+hexdigits = '0123456789abcdef'
+
+benign_tlds = ['com', 'net', 'org', 'de', 'info']
+
+necurs_tlds = ['ac','bit','biz','bz','cc','cn','co','com','cx','de','eu','ga','im','in','ir','jp',
+               'ki','kz','la','me','mn','ms','mu','mx','net','nf','nu','org','pro','pw','ru','sc',
+               'sh','so','su','sx','tj','to','tv','tw','ug','us','xxx']
+
+bankpatch_words = ['apontis','aulmala','berhogel','dminmont','ednog','edsafe','erhogeld','erobots',
+                   'esroater','fnomosk','ierihon','moboma','musallier','nconnect','ndsontex','newnacion',
+                   'rethedel','seapollo','susaname','tomvade','tvolveras']
+
+def _chars(rng, alphabet, n):
+    return ''.join(rng.choice(alphabet) for _ in range(n))
+
+def _syllables(rng, n, first=consonants, second=vowels):
+    return ''.join(rng.choice(first) + rng.choice(second) for _ in range(n))
+
+def _bankpatch(rng):
+    return ['%s%s.com' % (_chars(rng, letters, 4), rng.choice(bankpatch_words))]
+
+def _bedep(rng):
+    tail = ''.join(rng.choice('0123456789') if rng.random() < 0.5 else rng.choice(letters) for _ in range(2))
+    return ['%s%s.com' % (_chars(rng, letters, rng.randint(11, 16)), tail)]
+
+def _conficker_ab(rng):
+    return ['%s.%s' % (_chars(rng, letters, rng.randint(5, 11)), rng.choice(['biz','com','info','net','org','cc']))]
+
+def _dga_10(rng):
+    return ['n.%s.ru' % _chars(rng, letters, 9)]
+
+def _dyre(rng):
+    return ['%s%s.%s' % (rng.choice(letters), _chars(rng, hexdigits, 33), rng.choice(['cc','cn','hk','in','so','tk','to','ws']))]
+
+def _elephant(rng):
+    label = _chars(rng, hexdigits, 8)
+    return ['%s.%s' % (label, tld) for tld in rng.sample(['com', 'info', 'net'], rng.randint(2, 3))]
+
+def _expiro(rng):
+    head = rng.choice(letters) + _syllables(rng, 2)
+    if rng.random() < 0.5:
+        return ['%s-%s%s.com' % (head, _syllables(rng, 2), rng.choice(consonants))]
+    return ['%s%s-%s.ru' % (head, rng.choice(consonants), _syllables(rng, 2, vowels, consonants))]
+
+def _hyphen_dga(rng):
+    label = list(_chars(rng, letters, rng.randint(11, 23)))
+    for p in rng.sample(range(1, len(label) - 1, 2), rng.randint(1, 2)):
+        label[p] = '-'
+    return ['%s.com' % ''.join(label)]
+
+def _necurs(rng):
+    return ['%s.%s' % (_chars(rng, letters, rng.randint(10, 23)), rng.choice(necurs_tlds))]
+
+def _pitou(rng):
+    label = _chars(rng, letters, 5) + rng.choice('ab') + rng.choice(letters) + rng.choice('ab') + _chars(rng, letters, rng.randint(0, 1))
+    return ['%s.%s' % (label, rng.choice(['biz','com','info','me','mobi','name','net','org','us']))]
+
+def _pushdo(rng):
+    label = _syllables(rng, 6)[:rng.randint(9, 12)]
+    prefix = 'www.' if rng.random() < 0.3 else ''
+    return ['%s%s.%s' % (prefix, label, 'kz' if rng.random() < 0.6 else rng.choice(['com','in','info','net']))]
+
+def _pykspa(rng):
+    return ['%s.%s' % (_chars(rng, letters, rng.randint(6, 12)), rng.choice(['biz','com','info','net','org']))]
+
+def _ramdo(rng):
+    return ['%s.org' % _chars(rng, 'acegikmoqsuwy', 16)]
+
+def _runforestrun_l2(rng):
+    return ['%s.%s' % (_chars(rng, letters, 16), rng.choice(['info', 'ru']))]
+
+def _runforestrun_waw(rng):
+    return ['%s.waw.pl' % _chars(rng, letters, 16)]
+
+def _shiotob(rng):
+    label = list(_chars(rng, letters, rng.randint(10, 15)))
+    label[1] = rng.choice('123459')
+    label[5] = rng.choice('123459')
+    return ['%s.%s' % (''.join(label), rng.choice(['com', 'net']))]
+
+def _silly_fdc(rng):
+    return ['%s%s%s.info' % ('0-' * 13, _chars(rng, '0123456789', rng.randint(2, 3)), '-0' * 13)]
+
+families = {
+    'bankpatch':        _bankpatch,
+    'bedep':            _bedep,
+    'conficker-ab':     _conficker_ab,
+    'dga-10':           _dga_10,
+    'dyre':             _dyre,
+    'elephant':         _elephant,
+    'expiro':           _expiro,
+    'hyphen-dga':       _hyphen_dga,
+    'necurs':           _necurs,
+    'pitou':            _pitou,
+    'pushdo':           _pushdo,
+    'pykspa':           _pykspa,
+    'ramdo':            _ramdo,
+    'runforestrun-l2':  _runforestrun_l2,
+    'runforestrun-waw': _runforestrun_waw,
+    'shiotob':          _shiotob,
+    'silly-fdc':        _silly_fdc
+}
+
+class Workload(object):
+    '''
+    A seeded synthetic hplDNSReplies workload.
+
+    - clients: number of clients, infected ones included
+    - infected: number of infected clients per DGA family
+    - benign_rate: replies per client and hour, nx_ratio of them NXDOMAIN
+    - dga_rate: DGA lookups per infected client and hour
+    - chatty_clients, chatty_rate: misconfigured clients producing NXDOMAINs at a high rate
+    '''
+
+    def __init__(self, clients, infected=2, start=datetime(2015, 8, 10), duration=timedelta(hours=2),
+                 benign_rate=50, nx_ratio=0.05, dga_rate=60, chatty_clients=0, chatty_rate=2000,
+                 families=sorted(families), seed=0):
+        if clients < infected * len(families) + chatty_clients:
+            raise ValueError('Not enough clients for %d infected per family and %d chatty clients.' % (infected, chatty_clients))
+        self.clients = clients
+        self.start = start
+        self.end = start + duration
+        self.duration = duration
+        self.benign_rate = benign_rate
+        self.nx_ratio = nx_ratio
+        self.dga_rate = dga_rate
+        self.chatty_rate = chatty_rate
+        self.families = families
+        self.seed = seed
+
+        rng = random.Random(seed)
+        chosen = rng.sample(range(clients), infected * len(families) + chatty_clients)
+        self.infected = dict( (f, [self.client_name(c) for c in chosen[i*infected:(i+1)*infected]]) for i, f in enumerate(families) )
+        self.chatty = set(chosen[infected * len(families):])
+        self.infected_idx = dict( (c, families[i // infected]) for i, c in enumerate(chosen[:infected * len(families)]) )
+
+    @classmethod
+    def for_rows(cls, rows, infected=2, benign_rate=50, dga_rate=60, duration=timedelta(hours=2), **kwargs):
+        '''
+        Picks the number of clients so that the workload has about the given number of rows.
+        '''
+        hours = duration.total_seconds() / 3600
+        n_families = len(kwargs.get('families', families))
+        dga_rows = infected * n_families * dga_rate * hours
+        clients = max(infected * n_families + kwargs.get('chatty_clients', 0),
+                      int((rows - dga_rows) / (benign_rate * hours)))
+        return cls(clients, infected=infected, benign_rate=benign_rate, dga_rate=dga_rate, duration=duration, **kwargs)
+
+    @staticmethod
+    def client_name(idx):
+        return '10.%d.%d.%d' % (idx >> 16 & 255, idx >> 8 & 255, idx & 255)
+
+    def rows(self):
+        '''
+        Yields (request, client, cat, epoch timestamp) tuples, the same ones on every call.
+        '''
+        rng = random.Random(self.seed)
+        t_start = linnea_local.epoch(self.start)
+        span = int(self.duration.total_seconds())
+        hours = span / 3600
+        popular = [ '%s%s.%s' % (_syllables(rng, rng.randint(2, 4)), rng.choice(['', 'net', 'web', 'mail']), rng.choice(benign_tlds))
+                    for _ in range(1000) ]
+        for idx in range(self.clients):
+            client = self.client_name(idx)
+            for _ in range(int(self.benign_rate * hours)):
+                domain = rng.choice(popular)
+                if rng.random() < self.nx_ratio:
+                    typo = rng.randrange(len(domain.split('.')[0]))
+                    yield domain[:typo] + domain[typo+1:], client, 'NXDOMAIN', t_start + rng.randrange(span)
+                else:
+                    yield domain, client, 'NOERROR', t_start + rng.randrange(span)
+            if idx in self.chatty:
+                for _ in range(int(self.chatty_rate * hours)):
+                    yield '%s.%s' % (_chars(rng, letters, rng.randint(5, 12)), rng.choice(benign_tlds)), client, 'NXDOMAIN', t_start + rng.randrange(span)
+            family = self.infected_idx.get(idx)
+            if family:
+                generate = families[family]
+                for _ in range(int(self.dga_rate * hours)):
+                    t = t_start + rng.randrange(span)
+                    for i, domain in enumerate(generate(rng)):
+                        yield domain, client, 'NXDOMAIN', min(t + i, t_start + span)
+
+def reset_peak_memory():
+    '''
+    Resets the peak resident set size of this process, only possible on Linux.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+def peak_memory():
+    '''
+    Peak resident set size of this process in bytes.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run(sizes, database=':memory:', directory='examples', seed=0, bucket_minutes=0, **workload_args):
+    '''
+    Runs every detector on workloads of the given sizes, returns a list of
+    (rows, detector, seconds, peak bytes, flagged, recall) tuples.
+    '''
+    results = []
+    print('rows', 'detector', 'seconds', 'peak MB', 'flagged', 'recall', sep='\t| ')
+    for size in sizes:
+        workload = Workload.for_rows(size, seed=seed, **workload_args)
+        connection = linnea_local.connect(database)
+        linnea_local.create_table(connection, drop=True)
+        t0 = time.time()
+        n = linnea_local.load_rows(connection, workload.rows())
+        print('-'*79)
+        print('Loaded %d rows from %d clients in %.2fs' % (n, workload.clients, time.time() - t0))
+
+        for family in workload.families:
+            src = open('%s/%s.linn' % (directory, family)).read()
+            sql_query = linnea_local.compile_source(src, workload.end, True, bucket_minutes)
+
+            reset_peak_memory()
+            t0 = time.time()
+            flagged = set(row[0] for row in linnea_local.execute(connection, sql_query))
+            dt = time.time() - t0
+            peak = peak_memory()
+
+            truth = set(workload.infected[family])
+            recall = len(flagged & truth) / len(truth)
+            results.append((n, family, dt, peak, len(flagged), recall))
+            print(n, family, '%.2f' % dt, '%.1f' % (peak / 2**20), len(flagged), '%.2f' % recall, sep='\t| ')
+        connection.close()
+    return results
+
+def main(max_rows=10**8, database=':memory:', seed=0, bucket_minutes=0):
+    sizes = []
+    size = 10**4
+    while size <= int(max_rows):
+        sizes.append(size)
+        size *= 10
+    run(sizes, database, seed=int(seed), bucket_minutes=int(bucket_minutes))
+
+if __name__ == '__main__':
+    import sys
+    main(*sys.argv[1:])
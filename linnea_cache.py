@@ -0,0 +1,217 @@
+'''
+Local cache of hplDNSReplies slices.
+
+Fetches the rows of a time range from the warehouse once, in bulk, and stores
+them partitioned by hour as memory-mappable columnar files: timestamps as
+epoch seconds and every string column as int32 codes into a per partition
+string dictionary. Later runs over the same range read the partitions
+zero-copy from disk, e.g. to feed the local stand-in engine.
+'''
+from __future__ import print_function
+
+from datetime import datetime, timedelta
+import linnea
+import linnea_local
+import numpy
+import os
+import shutil
+
+
+hour_format = '%Y-%m-%d-%H'
+
+# Marks a partition of an hour that had not ended when it was fetched
+incomplete_marker = 'incomplete'
+
+string_columns = [ c for c in linnea_local.columns if c != 'timestamp' ]
+
+class Slice(object):
+    '''
+    One cached hour, columns are read-only memory-mapped arrays.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.hour = datetime.strptime(os.path.basename(path), hour_format)
+        self.timestamp = numpy.load(os.path.join(path, 'timestamp.npy'), mmap_mode='r')
+        self.codes = dict( (c, numpy.load(os.path.join(path, '%s.npy' % c), mmap_mode='r')) for c in string_columns )
+        self.offsets = numpy.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self._strings = None
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def strings(self):
+        '''
+        The decoded string dictionary.
+        '''
+        if self._strings is None:
+            with open(os.path.join(self.path, 'strings.bin'), 'rb') as f:
+                data = f.read()
+            self._strings = [ data[a:b].decode('utf-8') for a, b in zip(self.offsets[:-1], self.offsets[1:]) ]
+        return self._strings
+
+    def rows(self, start=None, end=None):
+        '''
+        Yields rows in the column order of the local engine, optionally only
+        those with start <= timestamp <= end (epoch seconds).
+        '''
+        mask = numpy.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.timestamp >= start
+        if end is not None:
+            mask &= self.timestamp <= end
+        idx = numpy.nonzero(mask)[0]
+        strings = self.strings()
+        columns = []
+        for c in linnea_local.columns:
+            if c == 'timestamp':
+                columns.append(self.timestamp[idx].tolist())
+            else:
+                columns.append([ strings[code] if code >= 0 else None for code in self.codes[c][idx].tolist() ])
+        return zip(*columns)
+
+class SliceCache(object):
+    '''
+    Hour partitioned cache of the rows matching `where`, evicting the least
+    recently used partitions once it grows beyond max_bytes.
+    '''
+
+    def __init__(self, directory, max_bytes=2**31, where="cat='NXDOMAIN'"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.where = where
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def hours(start, end):
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        while hour <= end:
+            yield hour
+            hour += timedelta(hours=1)
+
+    def partition_path(self, hour):
+        return os.path.join(self.directory, hour.strftime(hour_format))
+
+    def missing(self, start, end):
+        '''
+        Hours of [start, end] not cached yet or cached before they ended.
+        '''
+        return [ hour for hour in self.hours(start, end)
+                 if not os.path.isdir(self.partition_path(hour))
+                 or os.path.exists(os.path.join(self.partition_path(hour), incomplete_marker)) ]
+
+    def fetch(self, connection, start, end, batch_size=100000, now=None):
+        '''
+        Fetches all hours of [start, end] not cached yet, one query per
+        contiguous range of missing hours. Hours that have not ended by now
+        are marked incomplete and fetched again next time.
+        '''
+        now = now or datetime.now()
+        runs = []
+        for hour in self.missing(start, end):
+            if runs and runs[-1][1] == hour:
+                runs[-1][1] = hour + timedelta(hours=1)
+            else:
+                runs.append([hour, hour + timedelta(hours=1)])
+
+        for run_start, run_end in runs:
+            partitions = dict( (hour, []) for hour in self.hours(run_start, run_end - timedelta(seconds=1)) )
+            cur = connection.cursor()
+            cur.execute('SELECT %s FROM %s WHERE timestamp >= ? AND timestamp < ? AND (%s)' % (
+                ', '.join(linnea_local.columns), linnea.table_name, self.where), (run_start, run_end))
+            ts = linnea_local.columns.index('timestamp')
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    row = list(row)
+                    partitions[row[ts].replace(minute=0, second=0, microsecond=0)].append(row)
+                    row[ts] = linnea_local.epoch(row[ts])
+            for hour, rows in sorted(partitions.items()):
+                self.write_partition(hour, rows, complete=hour + timedelta(hours=1) <= now)
+
+        self.evict(keep=set(self.partition_path(hour) for hour in self.hours(start, end)))
+
+    def write_partition(self, hour, rows, complete=True):
+        path = self.partition_path(hour)
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        dictionary = {}
+        strings = []
+        def code(s):
+            if s is None:
+                return -1
+            if s not in dictionary:
+                dictionary[s] = len(strings)
+                strings.append(s.encode('utf-8'))
+            return dictionary[s]
+
+        for i, c in enumerate(linnea_local.columns):
+            if c == 'timestamp':
+                column = numpy.array([ row[i] for row in rows ], dtype=numpy.int64)
+            else:
+                column = numpy.array([ code(row[i]) for row in rows ], dtype=numpy.int32)
+            numpy.save(os.path.join(tmp_path, '%s.npy' % c), column)
+
+        offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([ len(s) for s in strings ])
+        numpy.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_path, 'strings.bin'), 'wb') as f:
+            f.write(b''.join(strings))
+        if not complete:
+            open(os.path.join(tmp_path, incomplete_marker), 'w').close()
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def load(self, start, end):
+        '''
+        Returns the slices of [start, end], the range has to be fetched.
+        '''
+        missing = [ hour for hour in self.hours(start, end) if not os.path.isdir(self.partition_path(hour)) ]
+        if missing:
+            raise ValueError('Hours not cached: %s' % ', '.join(hour.strftime(hour_format) for hour in missing))
+        slices = []
+        for hour in self.hours(start, end):
+            path = self.partition_path(hour)
+            os.utime(path, None)
+            slices.append(Slice(path))
+        return slices
+
+    def partitions(self):
+        '''
+        Returns (last use, size in bytes, path) of every cached partition.
+        '''
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            result.append((os.path.getmtime(path), size, path))
+        return result
+
+    def evict(self, keep=()):
+        partitions = sorted(self.partitions())
+        total = sum(size for _, size, _ in partitions)
+        for _, size, path in partitions:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            shutil.rmtree(path)
+            total -= size
+
+def load_local(connection, slices, start=None, end=None):
+    '''
+    Loads cached slices into a local engine connection, returns the number of rows.
+    '''
+    n = 0
+    for s in slices:
+        n += linnea_local.insert_rows(connection, s.rows(start, end))
+    return n
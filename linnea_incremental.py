@@ -0,0 +1,129 @@
+'''
+Incremental batch runs for Linnea.
+
+Persists the partial counts per (partition, time bucket) of the windowed
+counts in the first layer above the root layer in a state table of the
+database. Each run only aggregates the rows that arrived since the previous
+run of the same detector and answers the predicates from the stored buckets,
+so the steady-state cost is proportional to the new data, not to the lookback.
+
+Eligible counts are those with an interval whose predicate does not contain
+another count; all other counts are computed as usual. Rows are deduplicated
+per run only, a domain queried again after the previous run is counted again.
+'''
+from __future__ import print_function
+
+from datetime import timedelta
+from linnea_parser import BuilderSQL, default_interval_template
+from linnea_range import root_bounds
+
+
+state_table = 'linnea_state'
+runs_table = 'linnea_state_runs'
+
+# Maximum number of partition columns of an eligible count
+partition_columns = 4
+
+def state_ddl():
+    return [
+        'CREATE TABLE IF NOT EXISTS %s (detector VARCHAR(64), counter VARCHAR(64), %s, bucket TIMESTAMP, n INTEGER)' % (
+            state_table, ', '.join('p%d VARCHAR(255)' % i for i in range(partition_columns))),
+        'CREATE TABLE IF NOT EXISTS %s (detector VARCHAR(64), until TIMESTAMP)' % runs_table ]
+
+def quote(s):
+    return "'%s'" % s.replace("'", "''")
+
+def eligible_joins(ctx):
+    '''
+    Returns the groups of bucketed counts that can be answered from the state,
+    grouped per sublayer as the builder joins them.
+    '''
+    if len(ctx.layers) < 2:
+        return []
+    return [ join for sublayer in ctx.layers[1]
+             for join in BuilderSQL.group_buckets([ b for b in sublayer['buckets']
+                                                    if not b['nested'] and len(b['group']) <= partition_columns ]) ]
+
+def compile_incremental(compiler, src, detector):
+    '''
+    Compiles an incremental run of a detector, the compiler needs a bucket
+    granularity. Returns (before, query, after): the statements to execute
+    before the query, updating the state, the query itself and the
+    statements to execute once its results are read, marking the run.
+
+    The lookback is the lower time bound of the root layer relative to t0,
+    the first run of a detector aggregates it. A run at or before the last
+    run of the detector, e.g. a repeated sweep, discards its state and starts
+    over like a first run. Results only match those of plain runs if runs are
+    one lookback apart: more frequent runs only evaluate the rows since the
+    previous run, less frequent ones also rows older than the lookback.
+    '''
+    lower, _ = root_bounds(src)
+    if lower is None or lower >= timedelta(0):
+        raise ValueError('Incremental runs need a lower bound of the timestamp before t0 in the first predicate set.')
+    lookback = -lower
+
+    ctx = compiler.parse(src)
+    builder = compiler.builder(ctx)
+    if not builder.bucket_seconds:
+        raise ValueError('Incremental runs need a bucket granularity.')
+
+    interval_template = compiler.interval_template or default_interval_template
+    def interval(seconds):
+        return interval_template.format(h=seconds//3600, m=(seconds//60)%60, s=seconds)
+
+    t0 = compiler.identifier_map['t0']
+    timestamp = builder.basis_columns['timestamp']
+    time_slice = builder.bucket_template.format(timestamp=timestamp, seconds=builder.bucket_seconds)
+    last_run = '(SELECT MAX(until) FROM %s WHERE detector = %s)' % (runs_table, quote(detector))
+    since = 'COALESCE((SELECT MAX(until) FROM %s WHERE detector = %s AND until < %s), %s - %s)' % (
+        runs_table, quote(detector), t0, t0, interval(int(lookback.total_seconds())))
+    builder.root_predicates.append('%s > %s' % (timestamp, since))
+
+    joins = eligible_joins(ctx)
+    ctes = [('new_rows', builder.build_root_layer(ctx.layers[0]))]
+    selects = []
+    for join in joins:
+        name = join[0]['name']
+        group = join[0]['group']
+        partition = [ 'p%d' % i for i in range(len(group)) ]
+        ctes.append(('%s_new' % name, [
+            'SELECT %s, %s AS bucket, %s' % (
+                ', '.join('%s AS %s' % (g, p) for g, p in zip(group, partition)), time_slice,
+                ', '.join('COUNT(%s OR NULL) AS %s_n' % (b['pred'], b['name']) for b in join)),
+            'FROM new_rows',
+            'GROUP BY %s' % ', '.join(group + [time_slice]) ]))
+        for b in join:
+            if selects:
+                selects.append('UNION ALL')
+            selects.append('SELECT %s, %s, %s, bucket, %s_n FROM %s_new WHERE %s_n > 0' % (
+                quote(detector), quote(b['name']), ', '.join(partition + ['NULL'] * (partition_columns - len(group))),
+                b['name'], name, b['name']))
+
+        builder.bucket_sources[name] = [
+            'SELECT %s, bucket AS %s_bucket, %s' % (
+                ', '.join('%s AS %s_%s' % (p, name, p) for p in partition), name,
+                ', '.join('SUM(CASE WHEN counter = %s THEN n ELSE 0 END) AS %s_n' % (quote(b['name']), b['name']) for b in join)),
+            'FROM %s' % state_table,
+            'WHERE detector = %s AND counter IN (%s) AND bucket <= %s + %s' % (
+                quote(detector), ', '.join(quote(b['name']) for b in join), t0, interval(join[0]['seconds'])),
+            'GROUP BY %s, bucket' % ', '.join(partition) ]
+
+    before = state_ddl() + [
+        'DELETE FROM %s WHERE detector = %s AND %s >= %s' % (state_table, quote(detector), last_run, t0),
+        'DELETE FROM %s WHERE detector = %s AND %s >= %s' % (runs_table, quote(detector), last_run, t0) ]
+    if selects:
+        insert = [ 'INSERT INTO %s (detector, counter, %s, bucket, n)' % (
+            state_table, ', '.join('p%d' % i for i in range(partition_columns))) ]
+        before.append(BuilderSQL.render(insert + builder.with_ctes(selects, ctes)))
+
+    query = builder.build_sql(with_group_by=compiler.with_group_by)
+
+    # Buckets are kept as long as the windows of the next run can reach them
+    retention = int(lookback.total_seconds()) + 2 * max([ b['seconds'] for join in joins for b in join ] + [0])
+    after = [
+        'INSERT INTO %s (detector, until) VALUES (%s, %s)' % (runs_table, quote(detector), t0),
+        'DELETE FROM %s WHERE detector = %s AND bucket < %s - %s' % (state_table, quote(detector), t0, interval(retention)),
+        'DELETE FROM %s WHERE detector = %s AND until < %s - %s' % (runs_table, quote(detector), t0, interval(retention)) ]
+
+    return before, query, after
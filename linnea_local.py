@@ -0,0 +1,109 @@
+'''
+Local stand-in engine for Linnea.
+
+Compiles programs for SQLite and runs them against a local copy of the
+hplDNSReplies table, so detectors can be evaluated without the warehouse.
+Timestamps are stored as UNIX epoch seconds (UTC) and intervals compile to
+plain seconds, which lets SQLite evaluate the RANGE windows.
+'''
+from __future__ import print_function
+
+from linnea_parser import SQLCompiler
+import linnea
+import calendar
+import re
+import sqlite3
+
+
+domain_levels = 10
+
+columns = ['request', 'dst', 'cat', 'timestamp'] + ['d%d' % i for i in range(domain_levels)]
+
+identifier_map = dict(linnea.identifier_map)
+
+function_map = dict(linnea.function_map)
+
+interval_template = '{s}'
+
+bucket_template = '({timestamp} - {timestamp} % {seconds})'
+
+# SQLite divides integers without remainder, the warehouse does not
+operator_map = { '/': '*1.0/' }
+
+def epoch(timestamp):
+    return calendar.timegm(timestamp.timetuple())
+
+def split_domain(request):
+    '''
+    Splits a domain into its levels d0 (top level domain) to d9.
+    '''
+    labels = request.split('.')[::-1][:domain_levels]
+    return labels + [None] * (domain_levels - len(labels))
+
+def regexp_instr(s, pattern):
+    if s is None:
+        return None
+    match = re.search(pattern, s)
+    return match.start() + 1 if match else 0
+
+def regexp_count(s, pattern):
+    if s is None:
+        return None
+    return len(re.findall(pattern, s))
+
+def connect(database=':memory:'):
+    connection = sqlite3.connect(database, check_same_thread=False)
+    connection.create_function('REGEXP_INSTR', 2, regexp_instr)
+    connection.create_function('REGEXP_COUNT', 2, regexp_count)
+    return connection
+
+def create_table(connection, drop=False):
+    if drop:
+        connection.execute('DROP TABLE IF EXISTS %s' % linnea.table_name)
+    connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (linnea.table_name, ', '.join(
+        '%s %s' % (c, 'INTEGER' if c == 'timestamp' else 'TEXT') for c in columns)))
+    connection.execute('CREATE INDEX IF NOT EXISTS %s_timestamp ON %s (timestamp)' % (linnea.table_name, linnea.table_name))
+
+def load_rows(connection, rows, batch_size=10000):
+    '''
+    Inserts (request, client, cat, epoch timestamp) tuples, deriving the
+    domain levels. Returns the number of inserted rows.
+    '''
+    return insert_rows(connection, ( [request, client, cat, timestamp] + split_domain(request)
+                                     for request, client, cat, timestamp in rows ), batch_size)
+
+def insert_rows(connection, rows, batch_size=10000):
+    '''
+    Inserts rows holding all columns, returns the number of inserted rows.
+    '''
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (linnea.table_name, ', '.join(columns), ', '.join('?' * len(columns)))
+    n = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            connection.executemany(sql, batch)
+            n += len(batch)
+            batch = []
+    if batch:
+        connection.executemany(sql, batch)
+        n += len(batch)
+    connection.commit()
+    return n
+
+def make_compiler(timestamp, with_group_by, bucket_minutes=0):
+    imap = dict(identifier_map)
+    imap['t0'] = '(%d)' % epoch(timestamp)
+
+    return SQLCompiler(linnea.table_name, imap, function_map, with_group_by,
+                       interval_template=interval_template, operator_map=operator_map,
+                       bucket_seconds=int(bucket_minutes)*60 or None, bucket_template=bucket_template,
+                       group_bucket_windows=True)
+
+def compile_source(src, timestamp, with_group_by, bucket_minutes=0):
+    return make_compiler(timestamp, with_group_by, bucket_minutes).compileSQL(src)
+
+def execute(connection, sql_query):
+    cur = connection.cursor()
+    cur.execute(sql_query)
+    return cur
@@ -13,11 +13,18 @@ from datetime import timedelta
 ParserElement.enablePackrat()
 import sys
 
+default_interval_template = "INTERVAL '{h} hour {m} minute'"
+
+default_bucket_template = "TIME_SLICE({timestamp}, {seconds}, 'SECOND')"
+
+# Comparisons with swapped operands, a < b is b > a
+flipped_operators = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
 
 class ParseContext(object):
 
 
-    def __init__(self, lookup_table, function_table):
+    def __init__(self, lookup_table, function_table, interval_template=None, operator_map=None, bucket_seconds=None):
         self.layers = []
         self.current_layer = None
         self.current_sublayer = None
@@ -26,6 +33,9 @@ class ParseContext(object):
         self.current_items = None
         self.lookup_table = lookup_table
         self.function_table = function_table
+        self.interval_template = interval_template or default_interval_template
+        self.operator_map = operator_map or {}
+        self.bucket_seconds = bucket_seconds
         self.define_table = {}
         
         self.mode_stack = []
@@ -70,7 +80,7 @@ class ParseContext(object):
         self.debug and print('down')
         self.current_sublayer_idx += 1
         if len(self.current_layer) <= self.current_sublayer_idx:
-            self.current_layer.append( {'select':[],'where':[]} )
+            self.current_layer.append( {'select':[],'where':[],'buckets':[]} )
         self.current_sublayer = self.current_layer[self.current_sublayer_idx]
         self.current_items = self.current_sublayer[self.current_mode]
         
@@ -126,7 +136,7 @@ class ParseContext(object):
         
     def new_layer(self):
         self.debug and print('new layer')
-        self.layers.append([{'select':[],'where':[]}])
+        self.layers.append([{'select':[],'where':[],'buckets':[]}])
         self.current_layer = self.layers[-1]
         self.current_sublayer_idx = 0
         self.current_sublayer = self.current_layer[self.current_sublayer_idx]
@@ -135,15 +145,29 @@ class ParseContext(object):
         
 class BuilderSQL():
     
-    def __init__(self, layers, columns, table_name='hplDNSReplies', basis_columns=dict(domain='request',client='dst',timestamp='timestamp')):
+    def __init__(self, layers, columns, table_name='hplDNSReplies', basis_columns=dict(domain='request',client='dst',timestamp='timestamp'),
+                 bucket_seconds=None, bucket_template=None, group_bucket_windows=False):
         '''
         - layers: The sql hierarchy
         - columns: The columns used in predicates
         - sql_params: timeslot properties
+        - bucket_seconds: time granularity of bucketed counts
+        - bucket_template: format string truncating {timestamp} to buckets of {seconds}
+        - group_bucket_windows: group the sliding sums once more before joining them
         '''
         self.layers = layers
         self.columns = columns
         self.current_layer_depth = 0
+        self.ctes = []
+        self.bucket_seconds = bucket_seconds
+        self.bucket_template = bucket_template or default_bucket_template
+        self.group_bucket_windows = group_bucket_windows
+        # Replacements for the per bucket counts, by counter name
+        self.bucket_sources = {}
+        # Additional predicates for the root layer
+        self.root_predicates = []
+        # Additional predicates for the rows of the top layer
+        self.result_predicates = []
         
         self.additional_rows = self.columns - set(basis_columns.values())
         self.additional_rows_str = ', '.join(sorted(self.additional_rows))
@@ -157,20 +181,33 @@ class BuilderSQL():
         sql = self.build_root_layer(self.layers[0])
         for layer in self.layers[1:]:
             sql = self.build_layer(layer, sql)
+        
+        if self.result_predicates:
+            sql = ['SELECT *', 'FROM (', sql, ') layer_result', 'WHERE ' + ' AND '.join(self.result_predicates)]
             
         if with_group_by:
             sql = ['SELECT {client}, COUNT({client}) AS freq'.format(**self.basis_columns), 'FROM (', sql, ') layer_group', 'GROUP BY {client}'.format(**self.basis_columns)]
             
-        def join_recursive(sql, depth):
-            return '\n'.join( '    '*depth + l if not isinstance(l, list) else join_recursive(l, depth + 1) for l in sql )
-        
-        sql_str = join_recursive(sql, 0)
+        sql_str = self.render(self.with_ctes(sql))
         
         for p, r in sql_params.items():
             sql_str = sql_str.replace('<%s>' % p, r)
         
         return sql_str
     
+    @staticmethod
+    def render(sql, depth=0):
+        return '\n'.join( '    '*depth + l if not isinstance(l, list) else BuilderSQL.render(l, depth + 1) for l in sql )
+    
+    def with_ctes(self, sql, ctes=None):
+        ctes = self.ctes if ctes is None else ctes
+        if not ctes:
+            return sql
+        with_clause = []
+        for i, (name, cte) in enumerate(ctes):
+            with_clause += ['%s%s AS (' % ('WITH ' if i == 0 else '), ', name), cte]
+        return with_clause + [')'] + sql
+    
     def build_root_layer(self, layer):
         if len(layer) > 1:
             raise ValueError('Lowest layer cannot contain any count for performance reasons.')
@@ -183,8 +220,9 @@ class BuilderSQL():
         'GROUP BY dst, request%s' % self.additional_rows_str ]
         sublayer = layer[0]
         sql = []
-        if sublayer['where']:
-            predicates = [ '    ' + ''.join(sublayer['where'][0] ) ] + [ '    AND ' + ''.join(items) for items in sublayer['where'][1:] ]
+        where = [ ''.join(items) for items in sublayer['where'] ] + self.root_predicates
+        if where:
+            predicates = [ '    ' + where[0] ] + [ '    AND ' + p for p in where[1:] ]
         else:
             predicates = [ 'TRUE' ]
         for l in root_template:
@@ -216,11 +254,72 @@ class BuilderSQL():
             where = ['WHERE ' + predicates[0]] + predicates[1:]
         else:
             where = []
-        sql = select + ['FROM ('] + [sql] + [') layer_%d' % self.current_layer_depth] + where
+        if sublayer['buckets']:
+            rows = 'layer_%d_rows' % self.current_layer_depth
+            self.ctes.append((rows, sql))
+            from_ = ['FROM %s layer_%d' % (rows, self.current_layer_depth)]
+            for join in self.group_buckets(sublayer['buckets']):
+                for bucket in join:
+                    select[-1] += ','
+                    select.append('    COALESCE(%s_buckets.%s, 0) AS %s' % (join[0]['name'], bucket['name'], bucket['name']))
+                from_ += self.build_bucket_join(join, rows)
+            sql = select + from_ + where
+        else:
+            sql = select + ['FROM ('] + [sql] + [') layer_%d' % self.current_layer_depth] + where
         
         self.current_layer_depth += 1
         
         return sql
+    
+    @staticmethod
+    def group_buckets(buckets):
+        '''
+        Groups bucketed counts sharing partition and interval, they get one aggregate.
+        '''
+        joins = []
+        for bucket in buckets:
+            key = (bucket['group'], bucket['interval'], bucket['nested'])
+            for join in joins:
+                if (join[0]['group'], join[0]['interval'], join[0]['nested']) == key:
+                    join.append(bucket)
+                    break
+            else:
+                joins.append([bucket])
+        return joins
+    
+    def build_bucket_join(self, buckets, rows):
+        '''
+        Joins the sliding sums of bucketed counts sharing partition and interval
+        to the rows of a sublayer. Each predicate is counted per (partition,
+        bucket), then summed over the buckets whose start lies within the
+        interval of the row's bucket.
+        '''
+        name = buckets[0]['name']
+        group = buckets[0]['group']
+        time_slice = self.bucket_template.format(timestamp=self.basis_columns['timestamp'], seconds=self.bucket_seconds)
+        partition = [ '%s_p%d' % (name, i) for i in range(len(group)) ]
+        counts = self.bucket_sources.get(name) or [
+            'SELECT %s, %s AS %s_bucket, %s' % (
+                ', '.join('%s AS %s' % (g, p) for g, p in zip(group, partition)), time_slice, name,
+                ', '.join('COUNT(%s OR NULL) AS %s_n' % (b['pred'], b['name']) for b in buckets)),
+            'FROM %s' % rows,
+            'GROUP BY %s' % ', '.join(group + [time_slice]) ]
+        window = [ 'SELECT {0}, {1}_bucket'.format(', '.join(partition), name) ]
+        for b in buckets:
+            window[-1] += ','
+            window.append('    SUM({0}_n) OVER(PARTITION BY {1} ORDER BY {2}_bucket RANGE BETWEEN {3} PRECEDING AND {3} FOLLOWING) AS {0}'.format(
+                b['name'], ','.join(partition), name, b['interval']))
+        window += [ 'FROM (', counts, ') %s_counts' % name ]
+        if self.group_bucket_windows:
+            # Buckets are unique already, grouping them once more lets engines that
+            # cannot index window results (SQLite) hash or index the join
+            window = [
+                'SELECT %s, %s_bucket, %s' % (', '.join(partition), name, ', '.join('MAX({0}) AS {0}'.format(b['name']) for b in buckets)),
+                'FROM (', window, ') %s_windows' % name,
+                'GROUP BY %s, %s_bucket' % (', '.join(partition), name) ]
+        on = [ '%s = %s_buckets.%s' % (g, name, p) for g, p in zip(group, partition) ]
+        on.append('%s = %s_buckets.%s_bucket' % (time_slice, name, name))
+        return ['LEFT JOIN (', window, ') %s_buckets' % name, 'ON ' + on[0]] + [ '    AND ' + o for o in on[1:] ]
         
 class SQLCompiler():
     class Element():
@@ -295,11 +394,12 @@ class SQLCompiler():
                          minutes=toks[2].value)
                 
             t = timedelta(hours=t['h'], minutes=t['m'])
-            self.value = dict(h=int(t.total_seconds())//3600, m=(int(t.total_seconds())//60)%60)
+            self.seconds = int(t.total_seconds())
+            self.value = dict(h=self.seconds//3600, m=(self.seconds//60)%60, s=self.seconds)
         def __repr__(self):
             return '%s' % self.value
         def visit(self, ctx):
-            ctx.emit("INTERVAL '{h} hour {m} minute'".format(**self.value))
+            ctx.emit(ctx.interval_template.format(**self.value))
     
     class FunctionCall(Element):
         def __init__(self, toks):
@@ -390,7 +490,24 @@ class SQLCompiler():
                     return o
             counter, recycle = ctx.generate_name(('count', recursiveDictify(list(self.group)), recursiveDictify(self.pred), recursiveDictify(self.time_interval)))
             ctx.emit(counter)
-            if not recycle:
+            if not recycle and self.time_interval and ctx.bucket_seconds:
+                ctx.down()
+                ctx.push_mode('select')
+                def capture(element):
+                    ctx.new_selected()
+                    element.visit(ctx)
+                    return ''.join(ctx.current_items.pop())
+                gen_idx = ctx.gen_idx
+                bucket = dict(name=counter,
+                              group=[ capture(g) for g in self.group ],
+                              pred=capture(self.pred),
+                              interval=capture(self.time_interval),
+                              seconds=self.time_interval.seconds)
+                bucket['nested'] = ctx.gen_idx != gen_idx
+                ctx.current_sublayer['buckets'].append(bucket)
+                ctx.up()
+                ctx.pop_mode()
+            elif not recycle:
                 ctx.down()
                 ctx.push_mode('select')
                 ctx.new_selected()
@@ -441,7 +558,7 @@ class SQLCompiler():
             return '%s %s %s' % (self.left, self.op, self.right)
         def visit(self, ctx):
             self.left.visit(ctx)
-            ctx.emit(' '+self.op.upper()+' ')
+            ctx.emit(' '+ctx.operator_map.get(self.op, self.op.upper())+' ')
             self.right.visit(ctx)
         
     class UnaryOp(Element):
@@ -553,18 +670,38 @@ class SQLCompiler():
     
     parser = predicate_list
     
-    def __init__(self, table_name, identifier_map, function_map, with_group_by=False):
+    def __init__(self, table_name, identifier_map, function_map, with_group_by=False, interval_template=None, operator_map=None,
+                 bucket_seconds=None, bucket_template=None, group_bucket_windows=False):
+        '''
+        - interval_template: format string for intervals, gets h, m and s (total seconds)
+        - operator_map: replacements for binary operators of the target dialect
+        - bucket_seconds: if set, counts with an interval are pre-aggregated in time buckets of this size
+        - bucket_template: format string truncating {timestamp} to buckets of {seconds}
+        - group_bucket_windows: group the sliding sums of bucketed counts before joining, for engines that cannot index window results
+        '''
         self.table_name = table_name
         self.identifier_map = identifier_map
         self.function_map = function_map
         self.with_group_by = with_group_by
+        self.interval_template = interval_template
+        self.operator_map = operator_map
+        self.bucket_seconds = bucket_seconds
+        self.bucket_template = bucket_template
+        self.group_bucket_windows = group_bucket_windows
     
-    def compileSQL(self, s):
-        ctx = ParseContext(self.identifier_map, self.function_map)
+    def parse(self, s):
+        ctx = ParseContext(self.identifier_map, self.function_map, self.interval_template, self.operator_map, self.bucket_seconds)
         
         parsed = self.parser.parseString(s, parseAll=True)
         parsed[0].visit(ctx)
-        return BuilderSQL(ctx.layers, ctx.used_columns, self.table_name, self.identifier_map).build_sql(with_group_by=self.with_group_by)
+        return ctx
+    
+    def builder(self, ctx):
+        return BuilderSQL(ctx.layers, ctx.used_columns, self.table_name, self.identifier_map, self.bucket_seconds, self.bucket_template,
+                          self.group_bucket_windows)
+    
+    def compileSQL(self, s):
+        return self.builder(self.parse(s)).build_sql(with_group_by=self.with_group_by)
         
     @classmethod
     def test(cls):
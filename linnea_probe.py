@@ -0,0 +1,102 @@
+'''
+Two-phase execution of Linnea programs.
+
+Runs a cheap probe on the root layer first, counting its rows and distinct
+clients. If the root layer holds fewer rows than any result needs, the upper
+layers are not run at all. Otherwise the program is compiled with a lowering
+chosen from the rows of the busiest client: bucketed windows if any client
+is dense, windows per row if all are sparse.
+'''
+from __future__ import print_function
+
+import math
+from linnea_parser import BuilderSQL, SQLCompiler, flipped_operators
+
+
+class Probe(object):
+    '''
+    Cardinality of the root layer, rows are distinct (client, domain) pairs.
+    '''
+
+    def __init__(self, rows, clients, max_client_rows):
+        self.rows = rows
+        self.clients = clients
+        self.max_client_rows = max_client_rows
+
+    def __repr__(self):
+        return '<probe: %d rows, %d clients, at most %d rows per client>' % (self.rows, self.clients, self.max_client_rows)
+
+def expression_min_rows(expr):
+    '''
+    Lower bound of the root rows needed to satisfy an expression, from the
+    comparisons of counts with constants. A count never exceeds the number
+    of root rows.
+    '''
+    if not isinstance(expr, SQLCompiler.BinaryOp):
+        return 0
+    if expr.op == 'and':
+        return max(expression_min_rows(expr.left), expression_min_rows(expr.right))
+    if expr.op == 'or':
+        return min(expression_min_rows(expr.left), expression_min_rows(expr.right))
+
+    left, op, right = expr.left, expr.op, expr.right
+    if isinstance(right, SQLCompiler.CountExpr):
+        left, right = right, left
+        op = flipped_operators.get(op, op)
+    if not isinstance(left, SQLCompiler.CountExpr) or not isinstance(right, (SQLCompiler.Integer, SQLCompiler.Float)):
+        return 0
+    if op in ('>=', '='):
+        return max(0, int(math.ceil(right.value)))
+    if op == '>':
+        return max(0, int(math.floor(right.value)) + 1)
+    return 0
+
+def min_rows(src):
+    '''
+    Lower bound of the root rows needed for any result of a program, all
+    predicates of a layer have to hold.
+    '''
+    program = SQLCompiler.parser.parseString(src, parseAll=True)[0]
+    return max([ expression_min_rows(pred) for predicate_set in program.preds for pred in predicate_set.preds ] + [0])
+
+def probe_sql(compiler, src):
+    ctx = compiler.parse(src)
+    builder = compiler.builder(ctx)
+    client = builder.basis_columns['client']
+    return BuilderSQL.render([
+        'SELECT SUM(n), COUNT(*), MAX(n)',
+        'FROM (', [
+            'SELECT %s, COUNT(*) AS n' % client,
+            'FROM (', builder.build_root_layer(ctx.layers[0]), ') layer_probe',
+            'GROUP BY %s' % client ], ') layer_clients' ])
+
+def probe(connection, compiler, src):
+    cur = connection.cursor()
+    cur.execute(probe_sql(compiler, src))
+    rows, clients, max_client_rows = cur.fetchone()
+    return Probe(rows or 0, clients, max_client_rows or 0)
+
+def choose_lowering(stats, needed, bucket_minutes=0, bucket_rows_per_client=1000):
+    '''
+    Returns 'skip' if no result is possible, 'bucketed' if bucketing is
+    enabled and a client has at least bucket_rows_per_client root rows,
+    'windows' otherwise. A few chatty clients dominate the cost of windows
+    per row, however sparse the others are.
+    '''
+    if not stats.rows or stats.rows < needed:
+        return 'skip'
+    if bucket_minutes and stats.max_client_rows >= bucket_rows_per_client:
+        return 'bucketed'
+    return 'windows'
+
+def plan(connection, make_compiler, src, timestamp, with_group_by, bucket_minutes=0, bucket_rows_per_client=1000):
+    '''
+    Probes the root layer of a program, returns (query, probe, lowering),
+    the query is None if the program cannot have results.
+    '''
+    stats = probe(connection, make_compiler(timestamp, with_group_by), src)
+    lowering = choose_lowering(stats, min_rows(src), bucket_minutes, bucket_rows_per_client)
+    if lowering == 'skip':
+        return None, stats, lowering
+    compiler = make_compiler(timestamp, with_group_by, bucket_minutes if lowering == 'bucketed' else 0)
+    return compiler.compileSQL(src), stats, lowering
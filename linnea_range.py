@@ -0,0 +1,174 @@
+'''
+Time-range chunked execution of Linnea programs.
+
+Runs a program over a long range [start, end] as chunks of a fixed length in
+parallel, each on its own connection. Every chunk reads its core extended by
+the reach of the program's windows on both sides, so counts of rows near the
+core edges see the same rows as in one query over the whole range, and only
+returns the rows whose timestamp falls into its core.
+
+The time bounds of the root layer referring to t0 are replaced by the chunk
+ranges, t0 is the end of the range elsewhere. Counts need an interval, a
+count without one spans the whole range. As in every query, a domain queried
+repeatedly by a client is one row at its latest time, here the latest within
+the chunk and its margins.
+'''
+from __future__ import print_function
+
+import concurrent.futures
+from datetime import datetime, timedelta
+from pyparsing import ParseResults
+from linnea_parser import SQLCompiler, flipped_operators
+import linnea
+
+
+def expression_reach(expr, bucket_seconds=0):
+    '''
+    Seconds a count in an expression looks back or ahead of a row, nested
+    counts add up.
+    '''
+    if isinstance(expr, SQLCompiler.CountExpr):
+        if not expr.time_interval:
+            raise ValueError('Count %s has no interval, it cannot be chunked.' % (expr,))
+        return expr.time_interval.seconds + bucket_seconds + expression_reach(expr.pred, bucket_seconds)
+    if isinstance(expr, SQLCompiler.Element):
+        children = vars(expr).values()
+    elif isinstance(expr, (list, tuple, ParseResults)):
+        children = expr
+    else:
+        return 0
+    return max([ expression_reach(child, bucket_seconds) for child in children ] + [0])
+
+def reach(src, bucket_seconds=0):
+    '''
+    Margin in seconds a chunk needs around its core, the reach of every layer
+    adds up. Bucketed windows reach one bucket further.
+    '''
+    program = SQLCompiler.parser.parseString(src, parseAll=True)[0]
+    return sum(max([ expression_reach(pred, bucket_seconds) for pred in predicate_set.preds ] + [0])
+               for predicate_set in program.preds)
+
+def t0_offset(expr):
+    '''
+    Seconds of t0, t0 + T or t0 - T relative to t0, None for other expressions.
+    '''
+    if isinstance(expr, SQLCompiler.Identifier) and expr.id == 't0':
+        return 0
+    if (isinstance(expr, SQLCompiler.BinaryOp) and expr.op in ('+', '-') and t0_offset(expr.left) == 0
+        and isinstance(expr.right, SQLCompiler.Interval)):
+        return expr.right.seconds if expr.op == '+' else -expr.right.seconds
+    return None
+
+def root_bounds(src):
+    '''
+    Returns the bounds (lower, upper) of the timestamps in the first predicate
+    set relative to t0 as timedeltas, None where it is unbounded.
+    '''
+    bounds = [None, None]
+    def visit(expr):
+        if not isinstance(expr, SQLCompiler.BinaryOp):
+            return
+        if expr.op == 'and':
+            visit(expr.left)
+            visit(expr.right)
+            return
+        left, op, right = expr.left, expr.op, expr.right
+        if isinstance(right, SQLCompiler.Identifier) and right.id == 'timestamp':
+            left, right = right, left
+            op = flipped_operators.get(op, op)
+        if not (isinstance(left, SQLCompiler.Identifier) and left.id == 'timestamp'):
+            return
+        offset = t0_offset(right)
+        if offset is None:
+            return
+        if op in ('>=', '>', '='):
+            bounds[0] = offset if bounds[0] is None else max(bounds[0], offset)
+        if op in ('<=', '<', '='):
+            bounds[1] = offset if bounds[1] is None else min(bounds[1], offset)
+
+    program = SQLCompiler.parser.parseString(src, parseAll=True)[0]
+    for pred in program.preds[0].preds:
+        visit(pred)
+    return tuple( timedelta(seconds=b) if b is not None else None for b in bounds )
+
+def chunks(start, end, length):
+    '''
+    Splits [start, end] into cores [a, b), the last one ends at end inclusively.
+    '''
+    result = []
+    while start < end:
+        result.append((start, min(start + length, end)))
+        start += length
+    return result or [(start, end)]
+
+def chunk_queries(make_compiler, src, start, end, length=timedelta(hours=6), with_group_by=linnea.with_group_by, bucket_minutes=0):
+    '''
+    Returns the query of every chunk of [start, end].
+    '''
+    def literal(t):
+        return make_compiler(t, False).identifier_map['t0']
+
+    margin = timedelta(seconds=reach(src, int(bucket_minutes) * 60))
+    queries = []
+    for core_start, core_end in chunks(start, end, length):
+        compiler = make_compiler(end, with_group_by, bucket_minutes)
+        ctx = compiler.parse(src)
+        t0 = compiler.identifier_map['t0']
+        root = ctx.layers[0][0]
+        root['where'] = [ items for items in root['where'] if t0 not in ''.join(items) ]
+
+        builder = compiler.builder(ctx)
+        timestamp = builder.basis_columns['timestamp']
+        builder.root_predicates += [
+            '%s >= %s' % (timestamp, literal(max(start, core_start - margin))),
+            '%s <= %s' % (timestamp, literal(min(end, core_end + margin))) ]
+        builder.result_predicates += [
+            '%s >= %s' % (timestamp, literal(core_start)),
+            '%s %s %s' % (timestamp, '<=' if core_end == end else '<', literal(core_end)) ]
+        queries.append(builder.build_sql(with_group_by=with_group_by))
+    return queries
+
+def execute_range(connect, make_compiler, src, start, end, length=timedelta(hours=6), with_group_by=linnea.with_group_by,
+                  bucket_minutes=0, connections=4):
+    '''
+    Runs the chunks of [start, end] on up to `connections` connections opened
+    by connect(). Returns (client, freq) rows with summed frequencies when
+    grouping by client, all rows in chunk order otherwise.
+    '''
+    def run(sql_query):
+        connection = connect()
+        try:
+            cur = connection.cursor()
+            cur.execute(sql_query)
+            return cur.fetchall()
+        finally:
+            connection.close()
+
+    queries = chunk_queries(make_compiler, src, start, end, length, with_group_by, bucket_minutes)
+    with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+        results = list(executor.map(run, queries))
+
+    if not with_group_by:
+        return [ row for rows in results for row in rows ]
+    freq = {}
+    for rows in results:
+        for client, n in rows:
+            freq[client] = freq.get(client, 0) + n
+    return sorted(freq.items())
+
+def main(filename, start, end, chunk_hours=6, connections=4, bucket_minutes=0):
+    import pytoml
+    import pyodbc
+    config = pytoml.loads(open('config.toml').read())
+    connection_string = linnea.odbc_connection_string(config)
+
+    rows = execute_range(lambda: pyodbc.connect(connection_string), linnea.make_compiler, open(filename).read(),
+                         datetime.strptime(start, linnea.timestamp_format), datetime.strptime(end, linnea.timestamp_format),
+                         timedelta(hours=float(chunk_hours)), True, int(bucket_minutes), int(connections))
+    print('-'*79)
+    for row in rows:
+        print(*row, sep='\t| ')
+
+if __name__ == '__main__':
+    import sys
+    main(*sys.argv[1:])
@@ -0,0 +1,59 @@
+'''
+Tests of the slice cache against an SQLite stand-in of the warehouse.
+'''
+from datetime import datetime
+import linnea
+import linnea_cache
+import linnea_local
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+class SliceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        sqlite3.register_adapter(datetime, lambda t: t.strftime(linnea.timestamp_format))
+        sqlite3.register_converter('TIMESTAMP', lambda s: datetime.strptime(s.decode(), linnea.timestamp_format))
+        self.warehouse = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        self.warehouse.execute('CREATE TABLE %s (%s)' % (linnea.table_name, ', '.join(
+            '%s %s' % (c, 'TIMESTAMP' if c == 'timestamp' else 'TEXT') for c in linnea_local.columns)))
+        self.directory = tempfile.mkdtemp()
+        self.cache = linnea_cache.SliceCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def insert(self, request, timestamp):
+        row = [request, '10.0.0.1', 'NXDOMAIN', timestamp] + linnea_local.split_domain(request)
+        self.warehouse.execute('INSERT INTO %s VALUES (%s)' % (linnea.table_name, ', '.join('?' * len(row))), row)
+
+    def cached(self, start, end):
+        return sorted(row[0] for s in self.cache.load(start, end) for row in s.rows())
+
+    def test_rows_arriving_after_fetch(self):
+        start, end = datetime(2015, 8, 10, 10), datetime(2015, 8, 10, 10, 59, 59)
+        self.insert('a.com', datetime(2015, 8, 10, 10, 5))
+        self.insert('b.com', datetime(2015, 8, 10, 10, 40))
+
+        self.cache.fetch(self.warehouse, start, end, now=datetime(2015, 8, 10, 10, 45))
+        self.assertEqual(self.cached(start, end), ['a.com', 'b.com'])
+        self.assertEqual(self.cache.missing(start, end), [start])
+
+        self.insert('c.com', datetime(2015, 8, 10, 10, 50))
+        self.cache.fetch(self.warehouse, start, end, now=datetime(2015, 8, 10, 11, 5))
+        self.assertEqual(self.cached(start, end), ['a.com', 'b.com', 'c.com'])
+        self.assertEqual(self.cache.missing(start, end), [])
+
+    def test_complete_hours_are_not_fetched_again(self):
+        start, end = datetime(2015, 8, 10, 10), datetime(2015, 8, 10, 10, 59, 59)
+        self.insert('a.com', datetime(2015, 8, 10, 10, 5))
+        self.cache.fetch(self.warehouse, start, end, now=datetime(2015, 8, 10, 12))
+
+        self.insert('b.com', datetime(2015, 8, 10, 10, 40))
+        self.cache.fetch(self.warehouse, start, end, now=datetime(2015, 8, 10, 12))
+        self.assertEqual(self.cached(start, end), ['a.com'])
+
+if __name__ == '__main__':
+    unittest.main()